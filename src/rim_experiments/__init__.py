@@ -1,10 +1,10 @@
-import functools, collections, torch, dataclasses, warnings, json
+import functools, collections, torch, dataclasses, warnings, json, multiprocessing
 from typing import Dict, List
 from rim_experiments.models import *
 from rim_experiments.metrics import *
 from rim_experiments.dataset import Dataset
 from rim_experiments import dataset
-from rim_experiments.util import _argsort, cached_property, df_to_coo
+from rim_experiments.util import _argsort, _empty_cache, cached_property
 
 
 @dataclasses.dataclass
@@ -29,8 +29,8 @@ class ExperimentResult:
         print(pd.DataFrame(self.user_rec).T)
 
     def save_results(self, fn):
-        with open(fn, 'w') as fp:
-            json.dump(dataclasses.asdict(self), fp)
+        with open(fn, 'w') as fp: # numpy scalars and arrays via tolist
+            json.dump(dataclasses.asdict(self), fp, default=lambda x: x.tolist())
 
     def get_mtch_(self, k=None, c=None, name="mtch_"):
         y = {}
@@ -46,7 +46,8 @@ class ExperimentResult:
 class Experiment:
     """ Produce item_rec / user_rec metrics;
     then sweeps through multipliers for relevance-diversity curve,
-    interpreting mult<1 as item min-exposure and mult>=1 as user max-limit
+    interpreting mult<1 as item min-exposure and mult>=1 as user max-limit;
+    n_jobs>1 fits the cpu-only baselines in parallel processes
     """
     def __init__(self, D, V,
         mult=[], # [0, 0.1, 0.2, 0.5, 1, 3, 10, 30, 100],
@@ -59,6 +60,7 @@ class Experiment:
         device="cpu",
         cvx=False,
         online=False,
+        n_jobs=1,
         **mtch_kw
         ):
         self.D = D
@@ -68,6 +70,7 @@ class Experiment:
         self.models_to_run = models_to_run
         self.model_hyps = model_hyps
         self.device = device
+        self.n_jobs = n_jobs
 
         if online:
             assert cvx, "online requires cvx"
@@ -75,14 +78,15 @@ class Experiment:
 
         self.mtch_kw = mtch_kw
 
+        event_stats = self.D.get_stats()['event_df']
         self.results = ExperimentResult(
             cvx, online,
             _k1 = self.D.default_item_rec_top_k,
             _c1 = self.D.default_user_rec_top_c,
             _kmax = len(self.D.item_in_test),
             _cmax = len(self.D.user_in_test),
-            item_ppl = self.D.get_stats()['event_df']['item_ppl'],
-            user_ppl = self.D.get_stats()['event_df']['user_ppl'],
+            item_ppl = event_stats['item_ppl'],
+            user_ppl = event_stats['user_ppl'],
         )
 
         # pass-through references
@@ -92,7 +96,7 @@ class Experiment:
 
 
     def metrics_update(self, name, S, T=None):
-        target_csr = df_to_coo(self.D.target_df)
+        target_csr = self.D.target_csr
         score_mat = self.D.transform(S).values
 
         if self.online:
@@ -193,11 +197,38 @@ class Experiment:
 
 
     def run(self):
-        for model in self.models_to_run:
-            print("running", model)
-            S = self.transform(model, self.D)
-            T = self.transform(model, self.V) if self.online else None
-            self.metrics_update(model, S, T)
+        pool, pending, async_results = None, [], {}
+
+        def submit_next():
+            if len(pending):
+                model = pending.pop(0)
+                async_results[model] = pool.apply_async(_transform_in_worker, (model, self.online))
+
+        if self.n_jobs > 1:
+            pool = multiprocessing.get_context("spawn").Pool(
+                self.n_jobs, _init_worker, (self.D, self.V))
+            # submit in the running order and keep at most n_jobs in flight,
+            # so that at most n_jobs finished scores wait in memory at a time
+            pending = [model for model in self.models_to_run if model in _CPU_MODELS]
+            for _ in range(self.n_jobs):
+                submit_next()
+
+        try:
+            for model in self.models_to_run:
+                print("running", model)
+                if model in async_results:
+                    S, T = async_results.pop(model).get()
+                    submit_next()
+                else:
+                    S = self.transform(model, self.D)
+                    T = self.transform(model, self.V) if self.online else None
+                self.metrics_update(model, S, T)
+                # release the scores and their device buffers before the next model
+                del S, T
+                _empty_cache()
+        finally:
+            if pool is not None:
+                pool.terminate()
 
 
     @cached_property
@@ -218,6 +249,22 @@ class Experiment:
         return HawkesPoisson(self._hawkes).fit(self.V)
 
 
+# baselines that fit on cpu without sharing cached fits (e.g. _hawkes) with other models
+_CPU_MODELS = ["Rand", "Pop", "EMA", "BPR-Item", "BPR-User", "LogisticMF"]
+
+
+def _init_worker(D, V):
+    global _worker_experiment
+    _worker_experiment = Experiment(D, V, models_to_run=[])
+
+
+def _transform_in_worker(model, online):
+    self = _worker_experiment
+    S = self.transform(model, self.D)
+    T = self.transform(model, self.V) if online else None
+    return (S, T)
+
+
 def main(name, *args, **kw):
     prepare_fn = getattr(dataset, name)
     D, V = prepare_fn(*args)
@@ -239,9 +286,11 @@ def plot_results(self, logy=True):
 
     for ax, df, xname, yname in zip(ax, df, xname, yname):
         if df is not None:
+            # pivot once to [method] x [metric, k or c]
+            pivoted = df.T.unstack()
             ax.plot(
-                df.loc['prec'].unstack().values.T,
-                df.loc[yname].unstack().values.T,
+                pivoted['prec'].values.T,
+                pivoted[yname].values.T,
                 '+:',
             )
         ax.set_xlabel(xname)
@@ -249,7 +298,7 @@ def plot_results(self, logy=True):
         if logy:
             ax.set_yscale('log')
     fig.legend(
-        df.loc['prec'].unstack().index.values,
+        pivoted.index.values,
         bbox_to_anchor=(0.1, 0.9, 0.8, 0), loc=3, ncol=4,
         mode="expand", borderaxespad=0.)
     fig.subplots_adjust(wspace=0.25)
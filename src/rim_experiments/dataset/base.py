@@ -1,7 +1,7 @@
 import pandas as pd, numpy as np, scipy as sp
 import functools, collections, warnings
 from rim_experiments.util import create_matrix, cached_property, perplexity, \
-                                 timed, warn_nan_output, groupby_collect, df_to_coo
+                                 timed, warn_nan_output, df_to_coo
 
 
 def _check_inputs(event_df, user_df, item_df):
@@ -13,12 +13,15 @@ def _check_inputs(event_df, user_df, item_df):
                                 "item_df must include all items in event_df"
 
     with timed("checking whether the events are sorted via necessary conditions"):
-        user_time = event_df[['USER_ID','TIMESTAMP']].values
-        if not (user_time[1:] >= user_time[:-1]).any(axis=1).all():
+        user_codes = event_df['USER_ID'].astype('category').cat.codes.values.astype(np.int64)
+        timestamps = event_df['TIMESTAMP'].values
+        if not np.logical_or(user_codes[1:] >= user_codes[:-1],
+                             timestamps[1:] >= timestamps[:-1]).all():
             warnings.warn("please sort events in [user, time] for best efficiency.")
 
     with timed("checking for repeated user-item events"):
-        nunique = len(set(event_df.set_index(['USER_ID', 'ITEM_ID']).index))
+        item_codes = event_df['ITEM_ID'].astype('category').cat.codes.values.astype(np.int64)
+        nunique = len(np.unique(user_codes * len(item_df) + item_codes))
         if nunique < len(event_df):
             warnings.warn(f"user-item repeat rate {len(event_df) / nunique - 1:%}")
 
@@ -37,44 +40,47 @@ def _holdout_and_trim_events(event_df, user_df, horizon):
     return event_df[event_df['TIMESTAMP'] < test_start + horizon].copy()
 
 
-def _augment_user_hist(user_df, event_df):
-    """ augment history length before test start time """
-    @timed("groupby, collect, reindex")
-    def fn(col_name):
-        hist = groupby_collect(
-            event_df[event_df['_holdout']==0].set_index('USER_ID')[col_name]
-            )
-        return hist.reindex(user_df.index).apply(
-            lambda x: x if isinstance(x, collections.abc.Iterable) else [])
+HistCSR = collections.namedtuple("HistCSR", ["indptr", "items", "timestamps"])
+
 
-    user_df = user_df.join(
-        fn("ITEM_ID").to_frame("_hist_items"), on='USER_ID'
-    ).join(
-        fn("TIMESTAMP").to_frame("_hist_ts"), on='USER_ID'
-    )
+def _augment_user_hist(user_df, event_df):
+    """ augment history stats before test start time; return the history in HistCSR layout,
+    where user_df.iloc[u] owns the slice indptr[u]:indptr[u+1] of items and timestamps
+    """
+    with timed("sorting histories by user"):
+        train_df = event_df[event_df['_holdout']==0]
+        user_codes = user_df.index.get_indexer(train_df['USER_ID'])
+        order = np.argsort(user_codes, kind='stable')
+        indptr = np.searchsorted(user_codes[order], np.arange(len(user_df)+1))
+        hist_items = train_df['ITEM_ID'].values[order]
+        hist_ts = train_df['TIMESTAMP'].values[order]
 
-    user_df['_timestamps'] = user_df.apply(
-        lambda x: x['_hist_ts'] + [x['TEST_START_TIME']], axis=1)
+    # span from the first event, or from the test start time if there is no history
+    hist_len = np.diff(indptr)
+    first_ts = user_df['TEST_START_TIME'].values.astype(float)
+    first_ts[hist_len>0] = hist_ts[indptr[:-1][hist_len>0]]
 
-    user_df['_hist_len'] = user_df['_hist_items'].apply(len)
-    user_df['_hist_span'] = user_df['_timestamps'].apply(lambda x: x[-1] - x[0])
-    return user_df
+    user_df = user_df.copy()
+    user_df['_hist_len'] = hist_len
+    user_df['_hist_span'] = user_df['TEST_START_TIME'] - first_ts
+    return user_df, HistCSR(indptr, hist_items, hist_ts)
 
 
 def _augment_item_hist(item_df, event_df):
     """ augment history inferred from training set """
-    return item_df.join(
-        event_df[event_df['_holdout']==0]
-        .groupby('ITEM_ID').size().to_frame('_hist_len')
-    ).fillna({'_hist_len': 0})
+    item_codes = item_df.index.get_indexer(event_df[event_df['_holdout']==0]['ITEM_ID'])
+    item_df = item_df.copy()
+    item_df['_hist_len'] = np.bincount(item_codes, minlength=len(item_df))
+    return item_df
 
 
 class Dataset:
     """
     A dataset class contains 3 related tables and we will infer columns with underscored names
         event_df: [USER_ID, ITEM_ID, TIMESTAMP]; will infer [_holdout]
-        user_df: [USER_ID, TEST_START_TIME]; will infer [_hist_items, _timestamps, _in_test]
+        user_df: [USER_ID, TEST_START_TIME]; will infer [_hist_len, _hist_span, _in_test]
         item_df: [ITEM_ID]; will infer [_hist_len, _in_test]
+    the training histories of users are kept in CSR layout; see hist_csr()
     """
     def __init__(self, event_df, user_df, item_df, horizon,
         min_user_len=1, min_item_len=1, print_stats=False):
@@ -83,7 +89,7 @@ class Dataset:
 
         print("augmenting and trimming data")
         self.event_df = _holdout_and_trim_events(event_df, user_df, horizon)
-        self.user_df = _augment_user_hist(user_df, self.event_df)
+        self.user_df, self._user_hist = _augment_user_hist(user_df, self.event_df)
         self.item_df = _augment_item_hist(item_df, self.event_df)
         self.horizon = horizon
 
@@ -114,17 +120,17 @@ class Dataset:
                 'avg hist len': self.user_in_test['_hist_len'].mean(),
                 'avg hist span': self.user_in_test['_hist_span'].mean(),
                 'horizon': self.horizon,
-                'avg target items': df_to_coo(self.target_df).sum(axis=1).mean(),
+                'avg target items': self.target_csr.sum(axis=1).mean(),
             },
             'item_df': {
                 '# warm items': sum(self.item_df['_in_test']),
                 '# cold items': sum(~self.item_df['_in_test']),
                 'avg hist len': self.item_in_test['_hist_len'].mean(),
-                'avg target users': df_to_coo(self.target_df).sum(axis=0).mean(),
+                'avg target users': self.target_csr.sum(axis=0).mean(),
             },
             'event_df': {
                 '# train events': sum(self.event_df['_holdout']==0),
-                '# test events': df_to_coo(self.target_df).sum(),
+                '# test events': self.target_csr.sum(),
                 'default_user_rec_top_c': self.default_user_rec_top_c,
                 'default_item_rec_top_k': self.default_item_rec_top_k,
                 "user_ppl": perplexity(self.user_in_test['_hist_len']),
@@ -140,6 +146,17 @@ class Dataset:
     def item_in_test(self):
         return self.item_df[self.item_df['_in_test']]
 
+    def hist_csr(self, user_mask=None):
+        """ HistCSR of training histories for the users in user_mask (default: all) """
+        if user_mask is None:
+            return self._user_hist
+        indptr, items, timestamps = self._user_hist
+        rows = np.flatnonzero(np.asarray(user_mask))
+        lengths = indptr[rows + 1] - indptr[rows]
+        new_indptr = np.hstack([0, np.cumsum(lengths)]).astype(indptr.dtype)
+        ind = np.arange(new_indptr[-1]) + np.repeat(indptr[rows] - new_indptr[:-1], lengths)
+        return HistCSR(new_indptr, items[ind], timestamps[ind])
+
     @cached_property
     def target_df(self):
         return create_matrix(
@@ -147,6 +164,10 @@ class Dataset:
             self.user_in_test.index, self.item_in_test.index, "df"
         )
 
+    @cached_property
+    def target_csr(self):
+        return df_to_coo(self.target_df).tocsr()
+
     @warn_nan_output
     def transform(self, S, user_index=None, fill_value=float("nan")):
         """ reindex the score matrix to match with test users and items """
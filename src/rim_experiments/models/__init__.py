@@ -45,8 +45,12 @@ class EMA:
         self.horizon = horizon
 
     def transform(self, D):
-        fn = lambda ts: np.exp(- (ts[-1] - np.array(ts[:-1])) / self.horizon).sum()
-        user_scores = list(map(fn, D.user_in_test['_timestamps'].values))
+        indptr, _, hist_ts = D.hist_csr(D.user_df['_in_test'])
+        lengths = np.diff(indptr)
+        test_start = D.user_in_test['TEST_START_TIME'].values
+        user_scores = np.bincount(np.repeat(np.arange(len(lengths)), lengths),
+            np.exp(- (np.repeat(test_start, lengths) - hist_ts) / self.horizon),
+            minlength=len(lengths))
 
         return ExponentiatedLowRankDataFrame(
             np.log(user_scores)[:, None], np.ones(len(D.item_df))[:, None], 1,
@@ -1,5 +1,5 @@
 import pandas as pd, numpy as np
-import functools
+import functools, numba
 from ..util import timed, ExponentiatedLowRankDataFrame
 
 from tick.hawkes import HawkesSumExpKern
@@ -12,12 +12,13 @@ class Hawkes:
         self.model = HawkesSumExpKern(1./scales, C=C, verbose=True, max_iter=max_iter)
         self._input_fn = functools.partial(_input_fn,
             horizon=horizon, training_eps=training_eps, hetero=hetero)
+        self.horizon = horizon
         self.hetero = hetero
 
     @timed("Hawkes.fit")
     def fit(self, D):
         input_fn = functools.partial(self._input_fn, training=True)
-        X = list(map(input_fn, D.user_in_test['_timestamps'].values))
+        X = list(map(input_fn, _get_timestamps(D)))
 
         self.model.fit(X)
         self._learned_coeffs = _get_learned_coeffs(self.model)
@@ -26,11 +27,11 @@ class Hawkes:
 
     @functools.lru_cache(1)
     def transform(self, D, state_only=False):
-        input_fn = functools.partial(self._input_fn, training=False)
-        X = list(map(input_fn, D.user_in_test['_timestamps'].values))
-
-        predict_fn = functools.partial(_predict_fn, decays=self.model.decays)
-        user_states = np.vstack([predict_fn(x[0], t) for (x, t) in X])
+        hist = D.hist_csr(D.user_df['_in_test'])
+        user_states = _predict_states_numba(
+            hist.indptr, hist.timestamps.astype(np.float64),
+            D.user_in_test['TEST_START_TIME'].values.astype(np.float64),
+            self.horizon, self.model.decays.astype(np.float64))
 
         if state_only:
             return pd.Series(user_states.tolist(), index=D.user_in_test.index)
@@ -41,12 +42,21 @@ class Hawkes:
                 self._learned_coeffs['x_base'],
             ])
             if hasattr(D, '_is_synthetic_data') and D._is_synthetic_data:
+                input_fn = functools.partial(self._input_fn, training=False)
+                X = list(map(input_fn, _get_timestamps(D)))
                 _verify_estimated_intensity(self.model, X, user_intensities)
             return ExponentiatedLowRankDataFrame(
                 np.log(user_intensities)[:, None], np.ones(len(D.item_df))[:, None], 1,
                 index=D.user_in_test.index, columns=D.item_df.index)
 
 
+def _get_timestamps(D):
+    """ history timestamps of the test users followed by their test start times """
+    hist = D.hist_csr(D.user_df['_in_test'])
+    return [np.hstack([ts, t]) for ts, t in zip(
+        np.split(hist.timestamps, hist.indptr[1:-1]), D.user_in_test['TEST_START_TIME'].values)]
+
+
 def _input_fn(raw_ts, horizon, training, training_eps, hetero):
     """ format to data and ctrl channels relative to the first observation """
     data = (np.array(raw_ts[1:-1]) - raw_ts[0]) / horizon
@@ -73,6 +83,7 @@ def _get_learned_coeffs(model):
 
 
 def _predict_fn(x, end_time, decays):
+    """ reference user states per _input_fn; tested against _predict_states_numba """
     decays = decays.reshape((-1, 1))
     h_by_x = decays * np.exp(- decays * (end_time - x.reshape((1, -1))))
     h_by_s = decays * np.exp(- decays * end_time)
@@ -83,6 +94,26 @@ def _predict_fn(x, end_time, decays):
     ])
 
 
+@numba.jit(nopython=True, parallel=True)
+def _predict_states_numba(indptr, hist_ts, test_start, horizon, decays):
+    """ same as _predict_fn over _input_fn for each user in the history CSR """
+    n_decays = len(decays)
+    out = np.empty((len(test_start), 2 * n_decays + 1))
+    for i in numba.prange(len(test_start)):
+        start, stop = indptr[i], indptr[i + 1]
+        origin = hist_ts[start] if stop > start else test_start[i]
+        end_time = (test_start[i] - origin) / horizon
+        for d in range(n_decays):
+            h_by_x = 0.0
+            for j in range(start + 1, stop):
+                x = (hist_ts[j] - origin) / horizon
+                h_by_x += decays[d] * np.exp(- decays[d] * (end_time - x))
+            out[i, d] = h_by_x
+            out[i, n_decays + d] = decays[d] * np.exp(- decays[d] * end_time)
+        out[i, 2 * n_decays] = 1
+    return out
+
+
 def _verify_estimated_intensity(model, X, user_intensities):
     print("verifying estimated intensity")
     for i, (x, y) in enumerate(zip(X, user_intensities)):
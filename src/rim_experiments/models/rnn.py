@@ -1,8 +1,8 @@
 import pandas as pd, numpy as np
-import functools
+import functools, copy
 
 import torch
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, Sampler, random_split
 from torch.nn.utils.rnn import pack_sequence, pad_packed_sequence
 
 from .word_language_model.model import RNNModel
@@ -17,12 +17,15 @@ class RNN:
     def __init__(self, item_df,
         num_hidden=128, nlayers=2, max_epochs=5,
         gpus=get_best_gpus() if torch.cuda.is_available() else 0,
-        truncated_input_steps=256, truncated_bptt_steps=32):
+        truncated_input_steps=256, truncated_bptt_steps=32, num_workers=0,
+        quantize_transform=False):
 
         self._padded_item_list = [None] + item_df.index.tolist()
+        self._tok_index = pd.Index(item_df.index)
         self._truncated_input_steps = truncated_input_steps
+        self._num_workers = num_workers
+        self._quantize_transform = quantize_transform
         self._collate_fn = functools.partial(_collate_fn,
-            tokenize={k:i for i,k in enumerate(self._padded_item_list)},
             truncated_input_steps=truncated_input_steps)
 
         self.model = _LitRNNModel(RNNModel(
@@ -38,18 +41,26 @@ class RNN:
     @empty_cache_on_exit
     @torch.no_grad()
     def transform(self, D):
-        dataset = D.user_in_test['_hist_items'].values
+        dataset = self._tokenize(D.hist_csr(D.user_df['_in_test']))
         collate_fn = functools.partial(self._collate_fn, training=False)
         m, n_events, sample_y = _get_dataset_stats(dataset, collate_fn)
         print(f"transforming {m} users with {n_events} events, "
               f"truncated@{self._truncated_input_steps} per user")
         print(f"sample_y={sample_y}")
 
-        batches = self.trainer.predict(
-            dataloaders=DataLoader(dataset, 1000, collate_fn=collate_fn))
-        delattr(self.model, "predict_dataloader")
+        # presort by decreasing lengths to pack without permutations; unpermute outputs
+        order = np.argsort([-len(seq) for seq in dataset], kind='stable')
+        dataloader = self._get_dataloader([dataset[i] for i in order], 1000,
+            functools.partial(collate_fn, enforce_sorted=True))
+        if self._quantize_transform:
+            quantized_model = self._get_quantized_model()
+            batches = [quantized_model(batch) for batch in dataloader]
+        else:
+            batches = self.trainer.predict(dataloaders=dataloader)
+            delattr(self.model, "predict_dataloader")
 
-        user_hidden, user_log_bias = [np.concatenate(x) for x in zip(*batches)]
+        inverse = np.argsort(order)
+        user_hidden, user_log_bias = [np.concatenate(x)[inverse] for x in zip(*batches)]
         ind_logits = np.hstack([
             user_hidden, user_log_bias[:, None], np.ones_like(user_log_bias)[:, None]
             ])
@@ -66,7 +77,7 @@ class RNN:
 
     @empty_cache_on_exit
     def fit(self, D):
-        dataset = D.user_df[D.user_df['_hist_len']>0]['_hist_items'].values
+        dataset = self._tokenize(D.hist_csr(D.user_df['_hist_len']>0))
         collate_fn = functools.partial(self._collate_fn, training=True)
         m, n_events, sample_y = _get_dataset_stats(dataset, collate_fn)
         print(f"fitting {m} users with {n_events} events, "
@@ -75,21 +86,74 @@ class RNN:
 
         train_set, valid_set = random_split(dataset, [m*4//5, (m - m*4//5)])
         self.trainer.fit(self.model,
-            DataLoader(train_set, 64, collate_fn=collate_fn, shuffle=True),
-            DataLoader(valid_set, 64, collate_fn=collate_fn),)
+            self._get_dataloader(train_set, 64, collate_fn, shuffle=True, persistent=True),
+            self._get_dataloader(valid_set, 64, collate_fn, persistent=True),)
         print("val_loss", self.model.val_loss)
 
         delattr(self.model, 'train_dataloader')
         delattr(self.model, 'val_dataloader')
         return self
 
-
-def _collate_fn(batch, tokenize, truncated_input_steps, training):
+    def _get_quantized_model(self):
+        """ int8 dynamic quantization of the decoder to run on cpu; the gru is kept in
+        fp32 because its quantization errors compound over time steps in the user states
+        """
+        model = torch.quantization.quantize_dynamic(
+            copy.deepcopy(self.model.model).cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+        return _LitRNNModel(model, self.model.truncated_bptt_steps).eval()
+
+    def _get_dataloader(self, dataset, batch_size, collate_fn, shuffle=False, persistent=False):
+        """ run collate_fn in num_workers workers, kept across epochs if persistent, and pin
+        the batches for async copies to gpus; shuffled batches are bucketed by truncated
+        lengths to reduce padding
+        """
+        if shuffle:
+            lengths = [len(seq) for seq in dataset]
+            if self._truncated_input_steps>0:
+                lengths = np.fmin(lengths, self._truncated_input_steps)
+            kw = {'batch_sampler': _SortedBucketBatchSampler(lengths, batch_size)}
+        else:
+            kw = {'batch_size': batch_size}
+        return DataLoader(dataset, collate_fn=collate_fn,
+            num_workers=self._num_workers, persistent_workers=persistent and self._num_workers>0,
+            pin_memory=self.trainer.num_gpus>0, **kw)
+
+    def _tokenize(self, hist):
+        """ tokenize all histories in one pass; token 0 is reserved for padding """
+        tokens = self._tok_index.get_indexer(hist.items) + 1
+        assert (tokens > 0).all(), "item_df must include all items in the histories"
+        return np.split(tokens, hist.indptr[1:-1])
+
+
+class _SortedBucketBatchSampler(Sampler):
+    """ shuffle into buckets of bucket_size batches, sort each bucket by lengths,
+    and yield its batches in a shuffled order
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.lengths) / self.batch_size))
+
+    def __iter__(self):
+        perm = torch.randperm(len(self.lengths)).numpy()
+        batches = []
+        for i in range(0, len(perm), self.batch_size * self.bucket_size):
+            bucket = perm[i : i + self.batch_size * self.bucket_size]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+            batches.extend(np.split(bucket, np.arange(
+                self.batch_size, len(bucket), self.batch_size)))
+        for b in torch.randperm(len(batches)).tolist():
+            yield batches[b].tolist()
+
+
+def _collate_fn(batch, truncated_input_steps, training, enforce_sorted=False):
     if truncated_input_steps>0:
         batch = [seq[-truncated_input_steps:] for seq in batch]
-    batch = [[0] + [tokenize[x] for x in seq] for seq in batch]
-    batch = [torch.tensor(seq, dtype=torch.int64) for seq in batch]
-    batch, lengths = pad_packed_sequence(pack_sequence(batch, False))
+    batch = [torch.as_tensor(np.hstack([0, seq]), dtype=torch.int64) for seq in batch]
+    batch, lengths = pad_packed_sequence(pack_sequence(batch, enforce_sorted))
     if training:
         return (batch[:-1].T, batch[1:].T) # TBPTT assumes NT layout
     else:
@@ -103,6 +167,13 @@ def _get_dataset_stats(dataset, collate_fn):
     return len(dataset), n_events, sample[1]
 
 
+@torch.jit.script
+def _decode_log_bias(last_hidden, weight, bias):
+    """ fused decoder and mean log-softmax offset on the same device """
+    pred_logits = torch.nn.functional.linear(last_hidden, weight, bias)
+    return (pred_logits.log_softmax(dim=1) - pred_logits).mean(dim=1)
+
+
 class _LitRNNModel(_LitValidated):
     def __init__(self, model, truncated_bptt_steps):
         super().__init__()
@@ -115,9 +186,14 @@ class _LitRNNModel(_LitValidated):
         TN_layout, lengths = batch
         hiddens = self.model.init_hidden(len(lengths))
         TNC_out, _ = self.model.rnn(self.model.encoder(TN_layout), hiddens)
-        last_hidden = TNC_out[lengths-1, np.arange(len(lengths))]
-        pred_logits = self.model.decoder(last_hidden)
-        log_bias = (pred_logits.log_softmax(dim=1) - pred_logits).mean(axis=1)
+        index = (lengths.to(TNC_out.device) - 1).view(1, -1, 1).expand(1, -1, TNC_out.shape[2])
+        last_hidden = TNC_out.gather(0, index)[0]
+        if isinstance(self.model.decoder, torch.nn.Linear):
+            log_bias = _decode_log_bias(
+                last_hidden, self.model.decoder.weight, self.model.decoder.bias)
+        else: # dynamically quantized decoder
+            pred_logits = self.model.decoder(last_hidden)
+            log_bias = (pred_logits.log_softmax(dim=1) - pred_logits).mean(dim=1)
         return last_hidden.cpu().numpy(), log_bias.cpu().numpy()
 
     def configure_optimizers(self):
@@ -117,9 +117,12 @@ def _argsort(S, tie_breaker=1e-10, device="cpu"):
         S_torch = S.eval(device)
     else:
         S_torch = torch.tensor(S, device=device)
-    if tie_breaker>0:
+    # S_torch is a fresh copy; update it in place to avoid more users x items temporaries
+    if tie_breaker>0 and S_torch.is_floating_point():
+        S_torch.add_(torch.rand(*S.shape, device=device).mul_(tie_breaker))
+    elif tie_breaker>0:
         S_torch = S_torch + torch.rand(*S.shape, device=device) * tie_breaker
-    argsort_ind = torch.argsort(-S_torch.reshape(-1)).cpu().numpy()
+    argsort_ind = torch.argsort(S_torch.reshape(-1).neg_()).cpu().numpy()
     return np.unravel_index(argsort_ind, S.shape)
 
 
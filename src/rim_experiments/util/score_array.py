@@ -131,6 +131,26 @@ class DotProdLowRankValues(ExponentiatedLowRankValues):
 
 
 
+def _fold_bias_logits(ind_logits, col_logits):
+    """ sum up the user-bias (col_logits==1) and item-bias (ind_logits==1) columns;
+    the dot products are unchanged, but the hidden dimension stops growing with products
+    """
+    user_bias = (col_logits == 1).all(axis=0)
+    item_bias = (ind_logits == 1).all(axis=0) & ~user_bias
+    if user_bias.sum() <= 1 and item_bias.sum() <= 1:
+        return ind_logits, col_logits
+
+    keep = ~user_bias & ~item_bias
+    ind_out, col_out = [ind_logits[:, keep]], [col_logits[:, keep]]
+    if user_bias.any():
+        ind_out.append(ind_logits[:, user_bias].sum(axis=1, keepdims=True))
+        col_out.append(np.ones((len(col_logits), 1)))
+    if item_bias.any():
+        ind_out.append(np.ones((len(ind_logits), 1)))
+        col_out.append(col_logits[:, item_bias].sum(axis=1, keepdims=True))
+    return np.hstack(ind_out), np.hstack(col_out)
+
+
 @dataclasses.dataclass(repr=False)
 class ExponentiatedLowRankDataFrame(ScoreExpression):
     """ mimics a pandas dataframe with exponentiated low-rank structures
@@ -184,8 +204,9 @@ class ExponentiatedLowRankDataFrame(ScoreExpression):
             np.arange(len(self)), index=self.index
             ).reindex(index, fill_value=-1).values
 
+        ind_logits, col_logits = _fold_bias_logits(ind_logits[new_ind], col_logits)
         return self.__class__(
-            ind_logits[new_ind], col_logits, self.sign, index, self.columns)
+            ind_logits, col_logits, self.sign, index, self.columns)
 
 
     def __mul__(self, other):
@@ -194,8 +215,9 @@ class ExponentiatedLowRankDataFrame(ScoreExpression):
             other = other.reindex(self.index, fill_value=0) \
                          .reindex(self.columns, axis=1, fill_value=0)
 
-            ind_logits = np.hstack([self.ind_logits, other.ind_logits])
-            col_logits = np.hstack([self.col_logits, other.col_logits])
+            ind_logits, col_logits = _fold_bias_logits(
+                np.hstack([self.ind_logits, other.ind_logits]),
+                np.hstack([self.col_logits, other.col_logits]))
             sign = self.sign * other.sign
 
             return self.__class__(ind_logits, col_logits, sign, self.index, self.columns)
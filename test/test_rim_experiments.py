@@ -56,3 +56,64 @@ def test_solve_cvx(maximization, expect, **kw):
     print(v)
     if expect is not None:
         assert np.allclose(pi, expect, atol=0.1)
+
+
+def test_rnn_quantize_transform():
+    """ the int8 decoder should keep the fp32 user states and bound the log-bias drift """
+    from rim_experiments.dataset import prepare_synthetic_data
+    from rim_experiments.models import RNN
+    D, _ = prepare_synthetic_data("split_by_user")
+    rnn = RNN(D.item_df, max_epochs=1, gpus=0, num_workers=0).fit(D)
+    fp32 = rnn.transform(D).ind_logits
+
+    rnn._quantize_transform = True
+    RNN.transform.cache_clear()
+    int8 = rnn.transform(D).ind_logits
+
+    assert np.allclose(fp32[:, :-2], int8[:, :-2], atol=1e-5)   # user hidden states
+    assert np.abs(fp32[:, -2] - int8[:, -2]).max() < 0.1        # user log-bias
+
+
+def test_synthetic_experiment_n_jobs():
+    """ cpu baselines transformed in worker processes should match the in-process run """
+    from rim_experiments import main
+    results = []
+    for n_jobs in [1, 2]:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        self = main("prepare_synthetic_data", "split_by_user", mult=[0.5, 3],
+            models_to_run=["Rand", "Pop", "EMA"], n_jobs=n_jobs)
+        results.append(self.results)
+
+    for name in ["item_rec", "user_rec"]:
+        serial, parallel = [pd.DataFrame(getattr(r, name)) for r in results]
+        assert np.allclose(serial, parallel)
+    for model in ["Rand", "Pop", "EMA"]:
+        serial, parallel = [pd.DataFrame(r.mtch_[model]) for r in results]
+        assert np.allclose(serial, parallel)
+
+
+def test_hawkes_predict_states():
+    """ the numba user states should match _predict_fn, including users without history """
+    from rim_experiments.dataset.base import Dataset
+    from rim_experiments.models.hawkes import _input_fn, _predict_fn, _predict_states_numba
+    rng = np.random.RandomState(0)
+    event_df = pd.DataFrame({
+        'USER_ID': rng.randint(0, 20, 200),
+        'ITEM_ID': rng.randint(0, 10, 200),
+        'TIMESTAMP': rng.rand(200) * 100,
+    }).sort_values(['USER_ID', 'TIMESTAMP'])
+    user_df = pd.DataFrame({'TEST_START_TIME': 80.0}, index=np.arange(25)) # 5 without events
+    D = Dataset(event_df, user_df, pd.DataFrame(index=np.arange(10)), 10.0, min_user_len=0)
+    decays = 1. / np.logspace(-6, 1)
+
+    hist = D.hist_csr(D.user_df['_in_test'])
+    states = _predict_states_numba(hist.indptr, hist.timestamps,
+        D.user_in_test['TEST_START_TIME'].values, 10.0, decays)
+
+    train_ts = D.event_df[D.event_df['_holdout']==0].groupby('USER_ID')['TIMESTAMP'].apply(list)
+    expect = [_predict_fn(x[0], end_time, decays) for x, end_time in [
+        _input_fn(train_ts.get(u, []) + [t], 10.0, False, 0, True)
+        for u, t in D.user_in_test['TEST_START_TIME'].items()]]
+    assert (D.user_in_test['_hist_len'] == 0).sum() == 5
+    assert np.allclose(states, expect, rtol=1e-10, atol=0)